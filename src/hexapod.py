@@ -3,6 +3,8 @@ Hexapod controller.
 """
 import uasyncio
 import gc
+from array import array
+from utime import ticks_ms, ticks_add, ticks_diff
 import ulogging as logging
 from lib.servo import ServoOscillator
 from lib.hcsr04 import HCSR04
@@ -17,11 +19,20 @@ REV = [90, 0, 90]    # Walk backwards
 ROTR = [0, 90, 180]   # Turn to the right on the spot in a forward direction
 ROTL = [180, 90, 0]   # Turn to the left on the spot in a forward direction
 
+# All valid steering directions, and the directions in which a steering angle
+# may be set. These are tuples of constants so they are not rebuilt on every
+# membership test.
+DIRECTIONS = ('fwd', 'rev', 'rotr', 'rotl')
+ANGLE_DIRECTIONS = ('fwd', 'rev')
+
 # These are defaults for the obstacle sensor
 # The number of milliseconds to wait between obstacle detection samples
 OBS_SAMPLE_DELAY = 10
 # The size of the moving average sample window for averaging obstacle samples
 OBS_SAMPLE_WINDOW = 20
+# The number of milliseconds between checks for a change in the averaged
+# obstacle distance. Consumers are notified of changes via the obstacle event.
+OBS_REPORT_DELAY = 1000
 
 # Default update time for the ServoOscillator class is every 5ms or 200Hz. Most
 # RC servos will need to receive the position update pulse at least every 20ms
@@ -56,6 +67,9 @@ class Hexapod:
     # milliseconds
     PERIOD_MAX = 3000   # Slow
     PERIOD_MIN = 500    # Fast
+    # The span between min and max periods, used to convert between period and
+    # speed percentage.
+    PERIOD_SPAN = PERIOD_MAX - PERIOD_MIN
     # This is min and max degrees the left and right servos may move per
     # oscillation cycle.
     # The min and max in theory is 0° - 180°, but the legs may be restricted due
@@ -112,13 +126,24 @@ class Hexapod:
         self._pins = pins
         self._period = clamp(setup.get('period', 2000), self.PERIOD_MIN, self.PERIOD_MAX)
         self._phase = setup.get('phase', FWD)
-        self._trim = setup.get('trim', [0, 0, 0])
+        # The trims are small signed angles, so we keep them in a signed byte
+        # array rather than a list of int objects.
+        self._trim = array('b', setup.get('trim', [0, 0, 0]))
         self._mid_ampl = setup.get('mid_ampl', 10)
         self._stroke = clamp(setup.get('stroke', 30), 0, self.STROKE_MAX)
         self._servos = []  # Will be set to Oscillator instances by _setOscillators
         self._paused = True
         self._steer_dir = 'fwd'
         self._steer_angle = 0
+        # The dict returned by the steer getter. It is kept up to date by the
+        # steer setter so that reading the steering does not allocate.
+        self._steer_dict = {'dir': self._steer_dir, 'angle': self._steer_angle}
+        # Cache for the speed property. This is set by the speed setter, and
+        # calculated from the period on first access otherwise.
+        self._speed = None
+        # Cache for the params property. Anything that changes a value
+        # returned by params must reset this to None so it will be rebuilt.
+        self._params = None
         # Read and update any saved trim values
         self._getSavedTrim()
         # Create the oscillators
@@ -128,6 +153,11 @@ class Hexapod:
         # Will we set by _setupObstacleSensor if an HCSR04 config is supplied
         # in the sense argument
         self._sense = None
+        # An event per obstacle listener, set by _watchObstacle on every
+        # obstacle change. See addObstacleListener()
+        self._obstacle_events = []
+        # The last obstacle distance read by _watchObstacle
+        self._obstacle = None
         self._setupObstacleSensor(sense)
 
     def _saveTrim(self):
@@ -180,7 +210,7 @@ class Hexapod:
                     )
                     return
                 # All good, replace the current trim settings
-                self._trim = trim_vals
+                self._trim = array('b', trim_vals)
         except OSError as exc:
             logging.error("%s: Error restoring saved trim values: %s", self.LOG_PREFIX, exc)
 
@@ -210,7 +240,7 @@ class Hexapod:
         self._steer_dir and self._steer_angle are valid values. No validation
         will be done.
         """
-        if self._steer_dir in ['fwd', 'rev', 'rotr', 'rotl']:
+        if self._steer_dir in DIRECTIONS:
             phase = globals().get(self._steer_dir.upper(), None)
             if phase is None:
                 logging.error(
@@ -228,7 +258,7 @@ class Hexapod:
         # Adjust the stoke if we're going forward or reverse and the steer
         # angle is not 0. We assume the steer values have been validated by the
         # caller.
-        if self._steer_angle and self._steer_dir in ['fwd', 'rev']:
+        if self._steer_angle and self._steer_dir in ANGLE_DIRECTIONS:
             # What percentage of the angle from 0 to 90 is the steering angle
             # set at?
             turn_perc = (abs(self._steer_angle) * 100)/90
@@ -266,6 +296,9 @@ class Hexapod:
             # we set from the calculated values.
             servo.amplitude = amplitudes[idx]
 
+        # The phase, period and amplitudes may have changed
+        self._params = None
+
     def _setupObstacleSensor(self, conf):
         """
         Sets up an HCSR04 Ultrasonic Sensor connected to sense obstacles.
@@ -293,6 +326,42 @@ class Hexapod:
             )
         )
 
+        # Create the task to watch for obstacle changes and signal the
+        # listeners.
+        uasyncio.create_task(self._watchObstacle())
+
+    async def _watchObstacle(self):
+        """
+        Task to watch the obstacle sensor average for changes, and notify all
+        obstacle listeners whenever it does change.
+
+        This allows any consumers interested in obstacles to wait on their
+        listener event instead of each polling the sensor themselves.
+
+        The last distance read is quantized to whole mm and cached, and is
+        what the obstacle property returns. Quantizing also means that sub-mm
+        jitter in the average does not trigger the event.
+        """
+        # We wake up at absolute times every OBS_REPORT_DELAY ms, so that the
+        # time spent in the loop body does not make the checks drift.
+        next_wake = ticks_ms()
+        while True:
+            dist = self._sense.avg()
+            if dist is not None:
+                dist = int(dist)
+            if dist != self._obstacle:
+                self._obstacle = dist
+                self.notifyObstacleListeners()
+            next_wake = ticks_add(next_wake, OBS_REPORT_DELAY)
+            delay = ticks_diff(next_wake, ticks_ms())
+            if delay > 0:
+                await uasyncio.sleep_ms(delay)
+            else:
+                # We are running late. Resync to now, but still yield to the
+                # other tasks.
+                next_wake = ticks_ms()
+                await uasyncio.sleep_ms(0)
+
     @property
     def oscState(self):
         """
@@ -337,6 +406,9 @@ class Hexapod:
         """
         Property to return the current servo properties.
 
+        The params dict is cached, and only rebuilt after any of the values
+        have changed. The returned dict should thus not be modified.
+
         Returns:
             {
                 'paused': boolean
@@ -349,6 +421,9 @@ class Hexapod:
                 'legs_ampl': [left, right],
             }
         """
+        if self._params is not None:
+            return self._params
+
         params = {}
         for param in [
                 '_paused',
@@ -359,10 +434,13 @@ class Hexapod:
                 '_mid_ampl',
                 '_stroke']:
             params[param[1:]] = getattr(self, param)
+        # ujson can not serialize an array, so trim is returned as a list
+        params['trim'] = list(self._trim)
         # Need to fetch the left and right amplitudes off the servos
         params['legs_ampl'] = [self._servos[s].amplitude for s in (LEFT, RIGHT)]
-        logging.info("%s: Returning params: %s", self.LOG_PREFIX, params)
+        logging.debug("%s: Rebuilt params: %s", self.LOG_PREFIX, params)
 
+        self._params = params
         return params
 
     @property
@@ -387,6 +465,7 @@ class Hexapod:
         gc.collect()
         logging.info("%s: Setting pause to: %s", self.LOG_PREFIX, paused)
         self._paused = paused
+        self._params = None
         # Now set the servo oscillator pause attribute for each leg
         for servo in self._servos:
             servo.pause = self._paused
@@ -397,7 +476,7 @@ class Hexapod:
         Returns the trim for each of the servos.
 
         Returns:
-            [left trim, mid trim, right trim]
+            A signed byte array as: [left trim, mid trim, right trim]
         """
         return self._trim
 
@@ -414,22 +493,31 @@ class Hexapod:
 
         Args:
             trim (list): [left trim, mid trim, right trim]
+
+        Raises:
+            ValueError if any trim value does not fit in a signed byte. No
+            trims will be changed in this case.
         """
         logging.info("%s: Setting servos trim: %s", self.LOG_PREFIX, trim)
+        # Validate all values up front so we never apply a partial trim
+        for val in trim:
+            if val is not None and not -128 <= val <= 127:
+                raise ValueError(f"Invalid trim value: {val}")
         # Run over each servo, setting both the self._trim element for the
         # servos, as well as the actual servo trim
-        for idx, servo in enumerate(self._servos):
-            logging.info(
+        for idx, (servo, val) in enumerate(zip(self._servos, trim)):
+            if val is None:
+                continue
+            logging.debug(
                 "%s: Setting servo %s trim to: %s",
                 self.LOG_PREFIX,
                 idx,
-                "Not changing" if trim[idx] is None else trim[idx]
+                val
             )
-            if trim[idx] is None:
-                continue
             # Set the servo trim and our trim value
-            servo.trim = trim[idx]
-            self._trim[idx] = trim[idx]
+            servo.trim = val
+            self._trim[idx] = val
+        self._params = None
 
         # Always save trim values locally after setting them
         self._saveTrim()
@@ -451,6 +539,7 @@ class Hexapod:
         # will cycle through each servo and force a pause, while the
         # center_servo() call will automatically do the pause for each servo.
         self._paused = True
+        self._params = None
         # Center all.
         for servo in self._servos:
             servo.center_servo(with_trim)
@@ -467,11 +556,10 @@ class Hexapod:
                 'angle': current angle off the direction
             }
 
+            NOTE: This is a shared dict that is updated in place whenever the
+                steering changes, so callers should not modify it.
         """
-        return {
-            'dir': self._steer_dir,
-            'angle': self._steer_angle
-        }
+        return self._steer_dict
 
     @steer.setter
     def steer(self, steer_val):
@@ -496,7 +584,7 @@ class Hexapod:
         direct = steer_val.get('dir', None)
         angle = steer_val.get('angle', None)
         if direct is not None:
-            if direct in ['fwd', 'rev', 'rotr', 'rotl']:
+            if direct in DIRECTIONS:
                 self._steer_dir = direct
                 # When getting any of these directional commands, we also
                 # immediately reset the steering angle.
@@ -506,21 +594,51 @@ class Hexapod:
                 raise ValueError(f"Invalid steering direction: {direct}")
 
         if angle is not None:
-            if self._steer_dir not in ['fwd', 'rev']:
+            if self._steer_dir not in ANGLE_DIRECTIONS:
                 raise ValueError(
                     "An angle can only be given when in 'fwd or "\
                     "'rev' direction"
                 )
-            if isinstance(angle, int) and (-90 <= angle <= 90):
+            # NOTE: We use an exact type check instead of isinstance since it
+            # is cheaper, and it also rejects bools, which are ints too.
+            if type(angle) is int and -90 <= angle <= 90: #pylint: disable=unidiomatic-typecheck
                 self._steer_angle = angle
                 update_osc = True
             else:
                 raise ValueError(f"Invalid steering angle: {angle}")
 
-        # Now update the oscillators if needed
+        # Now update the cached steer dict and oscillators if needed
         if update_osc:
+            self._steer_dict['dir'] = self._steer_dir
+            self._steer_dict['angle'] = self._steer_angle
             self._updateOscillators()
 
+    @property
+    def angle(self):
+        """
+        Gets the current steering angle.
+
+        Returns:
+            The current steering angle as an integer
+        """
+        return self._steer_angle
+
+    @angle.setter
+    def angle(self, val):
+        """
+        Sets the steering angle.
+
+        This is a shortcut for setting only the angle via the steer setter.
+
+        Args:
+            val (int): The steering angle between -90 and 90.
+
+        Raises:
+            ValueError with error message if val param is invalid, or if the
+            current direction does not allow setting an angle.
+        """
+        self.steer = {'angle': val}
+
     @property
     def speed(self):
         """
@@ -530,16 +648,20 @@ class Hexapod:
         Note that the longer/higher the period, the slower the speed and vice
         versa, meaning that the speed is inversely proportional to the period.
 
+        The speed is cached, so it is only calculated from the period if it
+        has not been set via the speed setter yet.
+
         Returns:
             The current speed percentage as an integer
 
         """
-        # Calculate the "slowness" percentage for the current period out of the
-        # max period allowed
-        slowness = (self._period -self.PERIOD_MIN) * 100 // (self.PERIOD_MAX - self.PERIOD_MIN)
-        # Return the inverted slowness to give the speed as a measure of
-        # fastness
-        return 100 - slowness
+        if self._speed is None:
+            # Calculate the "slowness" percentage for the current period out of
+            # the max period allowed
+            slowness = (self._period - self.PERIOD_MIN) * 100 // self.PERIOD_SPAN
+            # The inverted slowness gives the speed as a measure of fastness
+            self._speed = 100 - slowness
+        return self._speed
 
     @speed.setter
     def speed(self, val):
@@ -549,13 +671,15 @@ class Hexapod:
 
         Args:
             val (int): A percentage between 0 and 100 of the allowed speed
-            range.
+            range. Values outside this range are clamped to it.
 
         Raises:
-            ValueError with error message if val param is invalid.
+            ValueError with error message if val param is not an integer.
         """
-        if not (isinstance(val, int) and (0 <= val <= 100)):
+        # See the steer setter for why we do not use isinstance here
+        if type(val) is not int: #pylint: disable=unidiomatic-typecheck
             raise ValueError(f"Invalid speed percentage value: {val}")
+        val = clamp(val, 0, 100)
 
         # The speed is inversely proportional to period, so we need to first
         # get the "slowness" (inverse of the "fastness" which speed represents)
@@ -564,9 +688,11 @@ class Hexapod:
 
         # Now we can calculate what percentage this slowness will be of the
         # total allowed period, before offsetting it with the min period
-        self._period = (
-            slowness * (self.PERIOD_MAX - self.PERIOD_MIN) // 100
-        ) + self.PERIOD_MIN
+        self._period = (slowness * self.PERIOD_SPAN // 100) + self.PERIOD_MIN
+        # The period calculation is exact for all speed percentages, so the
+        # getter may simply return the speed we were given.
+        self._speed = val
+        self._params = None
 
         # Cycle over servo oscillators and set period
         for servo in self._servos:
@@ -587,8 +713,8 @@ class Hexapod:
         Returns:
             The current stroke percentage as an integer
         """
-        # Return the stoke percentage
-        return self._stroke * 100 // self.STROKE_MAX
+        # Return the stoke percentage from the lookup table
+        return self.STROKE_PCT[self._stroke]
 
     @stroke.setter
     def stroke(self, val):
@@ -597,16 +723,19 @@ class Hexapod:
 
         Args:
             val (int): A percentage between 0 and 100 used to calculate the
-                final stroke value from STROKE_MAX.
+                final stroke value from STROKE_MAX. Values outside this range
+                are clamped to it.
 
         Raises:
-            ValueError with error message if val param is invalid.
+            ValueError with error message if val param is not an integer.
         """
-        if not (isinstance(val, int) and (0 <= val <= 100)):
+        # See the steer setter for why we do not use isinstance here
+        if type(val) is not int: #pylint: disable=unidiomatic-typecheck
             raise ValueError(f"Invalid stroke percentage value: {val}")
+        val = clamp(val, 0, 100)
 
-        # Calculate the new stroke value
-        self._stroke = val * self.STROKE_MAX // 100
+        # Look up the new stroke value
+        self._stroke = self.STROKE_FROM_PCT[val]
 
         # If we set the amplitudes on the servos directly while there is a
         # steering angle set, we will mes up the steering. It's better to call
@@ -620,13 +749,72 @@ class Hexapod:
         """
         Property to check if there is an obstacle, and if so, how far ahead.
 
+        This is the last distance read by the _watchObstacle task, so it may
+        be up to OBS_REPORT_DELAY ms old, but it is always the value that
+        caused the obstacle listeners to be last notified.
+
         Returns:
             -1 if no obstacle distance sensor is configured
             None if no obstacle is currently detected
-            A value between 0 and the max sense range if an obstacle is
-            detected
+            An integer mm distance between 0 and the max sense range if an
+            obstacle is detected
         """
-        return -1 if self._sense is None else self._sense.avg()
+        return -1 if self._sense is None else self._obstacle
+
+    @property
+    def hasObstacleSensor(self):
+        """
+        Property to check if an obstacle distance sensor is configured.
+
+        Returns:
+            True if a sensor is configured, False otherwise
+        """
+        return self._sense is not None
+
+    def addObstacleListener(self):
+        """
+        Adds a new obstacle listener.
+
+        Every listener gets its own event which is set whenever the obstacle
+        distance changes. A uasyncio.Event is not a broadcast, so listeners
+        can not share one event without one clearing a change before another
+        has seen it.
+
+        Listeners should wait on their event, clear it, and then read the
+        obstacle property for the current distance. Once done, the listener
+        must be removed with removeObstacleListener().
+
+        Returns:
+            None if no obstacle distance sensor is configured, or else the
+            uasyncio.Event instance for the new listener.
+        """
+        if self._sense is None:
+            return None
+        event = uasyncio.Event()
+        self._obstacle_events.append(event)
+        return event
+
+    def removeObstacleListener(self, event):
+        """
+        Removes an obstacle listener added with addObstacleListener().
+
+        Args:
+            event (uasyncio.Event): The listener event to remove. Unknown
+                events are ignored.
+        """
+        if event in self._obstacle_events:
+            self._obstacle_events.remove(event)
+
+    def notifyObstacleListeners(self):
+        """
+        Sets the event for all obstacle listeners.
+
+        This is called by _watchObstacle on every obstacle change, but can
+        also be called to force listeners to act on the current obstacle
+        state.
+        """
+        for event in self._obstacle_events:
+            event.set()
 
     async def run(self):
         """
@@ -643,3 +831,15 @@ class Hexapod:
         logging.info("%s: creating update tasks for oscillators", self.LOG_PREFIX)
         for servo in self._servos:
             uasyncio.create_task(servo.update())
+
+# Lookup tables to convert between the stroke value and the stroke percentage
+# without any divisions. The stroke can only be one of STROKE_MAX + 1 values,
+# and the percentage one of 101 values, so these are small enough to compute
+# once here. They are set after the class definition since a comprehension in
+# the class body can not see the other class attributes.
+Hexapod.STROKE_PCT = tuple(
+    v * 100 // Hexapod.STROKE_MAX for v in range(Hexapod.STROKE_MAX + 1)
+)
+Hexapod.STROKE_FROM_PCT = tuple(
+    p * Hexapod.STROKE_MAX // 100 for p in range(101)
+)
@@ -7,31 +7,61 @@ main app with all the API endpoints exposed for the Hexapod.
 from webserver import gc, app, logging
 from webserver import runserver # Convenience import for main @pylint: disable=unused-import
 import ws_controller
+import ujson
+from uhashlib import sha256
+from ubinascii import hexlify
 
 #pylint: disable=broad-except
 
+# The hexapod params dict last serialized by getParams, and its JSON string.
+# The hexapod only builds a new params dict when any of the values change, so
+# as long as we get the same dict back, the JSON string is still valid.
+PARAMS_CACHE = None
+PARAMS_JSON = None
+# The ETag for the current PARAMS_JSON. This is derived from the JSON content
+# so that it stays valid across reboots, where a browser may still have a
+# cached copy from before the reboot.
+PARAMS_ETAG = None
+
 @app.before_request
-async def requestHook(request):
+def requestHook(request):
     """
     Hook that is called before every request.
 
     This is helpful to log the request details for all requests.
+
+    This hook does not await anything, so it is a plain function. Microdot
+    only awaits handlers that return a coroutine, so this saves creating and
+    scheduling a coroutine on every request.
+
+    NOTE: We do not touch request.json here since that will force the body
+        to be parsed as JSON for every request, even for routes that never
+        use it. The raw body is only logged at debug level, and only if
+        there is one.
     """
     logging.info(
-        "HTTP: %s %s, Args: %s, JSON: %s",
+        "HTTP: %s %s, Args: %s",
         request.method,
         request.path,
-        request.args,
-        request.json
+        request.args
     )
+    if request.body:
+        logging.debug("HTTP: Body: %s", request.body)
     gc.collect()
 
 @app.route('/get_params')
-async def getParams(request):
+def getParams(request):
     """
     Endpoint to return the current hexapod parameters and values as a JSON
     structure.
 
+    This is a plain (not async) handler since it does no I/O. See requestHook.
+
+    The JSON response is cached and only serialized again when the hexapod
+    params change. The response carries an ETag for the cached version, and if
+    the client sends that ETag back in an If-None-Match header, we respond with
+    a 304 and no body.
+
     GET Response:
     {
         "servo": {
@@ -56,4 +86,19 @@ async def getParams(request):
         "speed": (float),   # Period as a % of min and max periods
     }
     """
-    return request.app.hexapod.params
+    global PARAMS_CACHE, PARAMS_JSON, PARAMS_ETAG
+
+    params = request.app.hexapod.params
+    if params is not PARAMS_CACHE:
+        PARAMS_CACHE = params
+        PARAMS_JSON = ujson.dumps(params)
+        # The first 8 bytes of the hash is plenty to tell params apart
+        PARAMS_ETAG = '"%s"' % hexlify(sha256(PARAMS_JSON.encode()).digest()[:8]).decode()
+
+    if request.headers.get('If-None-Match') == PARAMS_ETAG:
+        return '', 304, {'ETag': PARAMS_ETAG}
+
+    return PARAMS_JSON, 200, {
+        'Content-Type': 'application/json',
+        'ETag': PARAMS_ETAG
+    }
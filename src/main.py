@@ -65,7 +65,7 @@ if __name__ == "__main__":
     if conf['web_app']['enabled']:
         from hexapod_api import runserver, app as webapp
         webapp.hexapod = hexapod
-        loop.create_task(runserver())
+        loop.create_task(runserver(debug=conf['debug']))
 
     loop.create_task(hexapod.run())
 
@@ -19,6 +19,7 @@ sys.path.insert(0, 'lib')
 #pylint: disable=wrong-import-position
 import uasyncio
 import ulogging as logging
+from array import array
 from lib import hcsr04
 from config import conf
 
@@ -44,7 +45,14 @@ class HCSR04Sim:
         """
         #pylint: disable=unused-argument
         self._max_range = max_range
-        self._buf = []
+        # The sample window is a ring buffer of unsigned 16 bit distances so
+        # that no objects are allocated per sample. It is set up by the
+        # monitor task, which also maintains the write index, sample count and
+        # running sum.
+        self._buf = None
+        self._head = 0
+        self._count = 0
+        self._sum = 0
         self._avg = None
 
     async def monitor(self, sample_delay=500, window=10):
@@ -53,11 +61,13 @@ class HCSR04Sim:
 
         To control the simulation from external, this task will monitor the
         file system for an input file (named by AVG_INPUT) with some sample
-        distance measures. If found, it will open the file and read distance
-        measure value from this file one line at a time, with a sample_delay
-        delay between each reading.
-        Each reading will then be pushed into the window, and the average
-        calculated.
+        distance measures. If found, it will open the file and read one
+        distance measure value from this file on every sample_delay tick.
+        Each reading will then be pushed into the window, evicting the oldest
+        reading if the window is full, and the average updated.
+        On ticks where there is no line to read, the window is drained by
+        one reading so that the average falls back to None once the input has
+        been consumed.
         Once all lines have been read, the file will be closed and then
         deleted. This will be a sign for the external process to know that all
         samples have been read.
@@ -65,13 +75,13 @@ class HCSR04Sim:
         Any invalid lines in the file will be ignored.
         """
         in_file = None
+        self._buf = array('H', bytes(window * 2))
+        self._head = 0
+        self._count = 0
+        self._sum = 0
         logging.info("Setting up HCSR04 monitor task.")
 
         while True:
-            # We drain the window by one on every iteration.
-            if self._buf:
-                self._buf.pop(0)
-
             # Do we need to look for the input file?
             if in_file is None:
                 # NOTE
@@ -98,40 +108,51 @@ class HCSR04Sim:
                 if self.AVG_INPUT in os.listdir():
                     in_file = open(self.AVG_INPUT)
 
-            # Do we have an open input file?
-            if in_file is not None:
-                # Read until a valid line is read, or we reach the end of the
-                # file, or we've filled the window
-                # Read lines from the file until we've filled the buffer with
-                # valid entries (invalid entries are ignored), or we get the
-                # end of the file.
-                while len(self._buf) < window:
-                    # This will return only an empty string without a newline
-                    # when at end of file.
-                    line = in_file.readline()
-
-                    # End of file?
-                    if line == '':
-                        # Close the file, reset in_file and exit the while loop
-                        in_file.close()
-                        in_file = None
-                        # Try to delete the file
-                        try:
-                            os.unlink(self.AVG_INPUT)
-                        except Exception:
-                            logging.error("Error deleting file: [%s]", self.AVG_INPUT)
-                        break
-                    # Remove the newline
-                    line = line.strip()
-                    # Valid?
-                    if line.isdigit():
-                        logging.info("Adding to measurements: %s", line)
-                        self._buf.append(float(line))
-                    else:
-                        logging.error("Ignoring invalid measurement: [%s]", line)
+            # We read at most one line per tick. This will return only an
+            # empty string without a newline when at end of file.
+            line = in_file.readline() if in_file is not None else ''
+
+            # End of file?
+            if line == '' and in_file is not None:
+                # Close the file and reset in_file
+                in_file.close()
+                in_file = None
+                # Try to delete the file
+                try:
+                    os.unlink(self.AVG_INPUT)
+                except Exception:
+                    logging.error("Error deleting file: [%s]", self.AVG_INPUT)
+
+            # Try to convert the line to a measurement
+            sample = None
+            if line:
+                try:
+                    val = int(line.strip())
+                    # Must fit in the unsigned 16 bit ring buffer
+                    if not 0 <= val <= 0xFFFF:
+                        raise ValueError
+                    # Only accept the sample once it is known to be valid
+                    sample = val
+                    logging.info("Adding to measurements: %s", sample)
+                except ValueError:
+                    logging.error("Ignoring invalid measurement: [%s]", line.strip())
+
+            # Evict the oldest reading if we have a new sample and the window
+            # is full, or if there was no line to read at all so we drain the
+            # window by one. An invalid line neither adds nor removes a
+            # reading.
+            if self._count and (
+                    not line or (sample is not None and self._count == window)):
+                self._sum -= self._buf[(self._head - self._count) % window]
+                self._count -= 1
+            if sample is not None:
+                self._buf[self._head] = sample
+                self._head = (self._head + 1) % window
+                self._count += 1
+                self._sum += sample
 
             # Update the average if we can
-            self._avg = None if not self._buf else round(sum(self._buf)/len(self._buf), 2)
+            self._avg = round(self._sum / self._count, 2) if self._count else None
 
             # Delay
             await uasyncio.sleep_ms(sample_delay)
@@ -178,7 +199,7 @@ logging.info("Setting up Hexapod.")
 hexapod = hexapod_mod.Hexapod(conf['pins'], conf['echo_sense'])
 
 webapp.hexapod = hexapod
-loop.create_task(runserver(port=5000))
+loop.create_task(runserver(port=5000, debug=True))
 
 loop.create_task(hexapod.run())
 
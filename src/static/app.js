@@ -64,6 +64,9 @@ let ws_url = localStorage.getItem('ws_url') || 'ws://' + location.host + '/ws';
 // This will be the global websocket managed by the wsConnect function
 let ws = null;
 
+// Decoder for binary websocket frames received from the hexapod
+const wsDecoder = new TextDecoder();
+
 /**
  * Opens a modal dialog as the message type and displays the message
  * provided.
@@ -540,7 +543,7 @@ function attachRangeSliderEvents() {
  * received, or if the detection state is switched on or off.
  *
  * Args:
- *  dist (float|str): One of the following:
+ *  dist (int|str): One of the following:
  *      * 'on'    - obstacle detection is switched on
  *      * 'off'   - obstacle detection is switched off
  *      * 'clear' - a previously detected obstacle has cleared
@@ -570,7 +573,7 @@ function updateObstacleDist(dist) {
 
     // We're not clear anymore, and we update the distance.
     obst_elem.classList.remove('clear');
-    dist_elem.textContent = Number(dist).toFixed(1);
+    dist_elem.textContent = dist;
 }
 
 
@@ -587,7 +590,7 @@ function updateObstacleDist(dist) {
  * Any messages arriving on the websock is expected to be in the
  * 'action:[args...]' format as defined by the Hexapod API. Once a message
  * arrives, the received args will be published as the message to the [action]
- * topic.
+ * topic. A single frame may contain multiple messages separated by newlines.
  **/
 function wsConnect() {
     // Already connected?
@@ -599,6 +602,9 @@ function wsConnect() {
 
     // Connect using the current host we loaded the site from.
     ws = new WebSocket(ws_url);
+    // The hexapod sends some pre-encoded messages as binary frames. We want
+    // these as ArrayBuffers so we can decode them to strings directly.
+    ws.binaryType = 'arraybuffer';
 
     // When the socket is connected, we publish the 'connected' message
     ws.onopen = function() {
@@ -616,13 +622,19 @@ function wsConnect() {
     // When a new message
     ws.onmessage = function(msg) {
         //console.log('[WS]: message:', msg);
-        // Split on colons so we can get the and optional args separately
-        let args = msg.data.split(':');
-        // Get the action out, leaving any optional args
-        let action = args.shift()
-        // Join the remaining args array with ':' again if it was split
-        args = args.join(":")
-        Q.pub(action, args)
+        // Binary frames are decoded to strings first
+        let data = typeof msg.data === 'string' ? msg.data : wsDecoder.decode(msg.data);
+        // A single frame may contain more than one message separated by
+        // newlines, so we handle each one separately.
+        data.split('\n').forEach(dat => {
+            // Split on colons so we can get the and optional args separately
+            let args = dat.split(':');
+            // Get the action out, leaving any optional args
+            let action = args.shift()
+            // Join the remaining args array with ':' again if it was split
+            args = args.join(":")
+            Q.pub(action, args)
+        });
     };
 
     ws.onclose = function(evt) {
@@ -4,11 +4,14 @@ Base webserver.
 This module instantiates the base webserver app and all static file serving.
 """
 import gc
+import os
+from ubinascii import hexlify
 
 from lib.microdot_asyncio import Microdot, send_file
 from lib.microdot_cors import CORS
 
 import ulogging as logging
+from version import VERSION
 
 # The main web app. On main app startup in main.py, after the hexapod instance has been
 # created, and this web app has been imported, the hexapod instance will be
@@ -25,6 +28,19 @@ CORS(app, allowed_origins='*', allow_credentials=True)
 # for static files.
 GZIPPED_STATIC = True
 
+# The ETag validator for static files served from /static. On the MCU these
+# files only change when the firmware is updated, so the browser may keep them
+# as long as it revalidates them on every page load (Cache-Control: no-cache),
+# and we can answer with a 304 instead of serving the file again.
+# The asset URLs in index.html are not versioned, so the browser must never
+# use a cached file without revalidating it: after an update a stale app.js
+# may not even speak the current websocket protocol. A firmware update always
+# involves a reboot, so the random per boot part, in addition to the version,
+# ensures that cached files are never validated across updates.
+# This is only applied when GZIPPED_STATIC is True, i.e. not when running
+# locally where the files may change at any time.
+STATIC_ETAG = '"%s-%s"' % (VERSION, hexlify(os.urandom(4)).decode())
+
 def staticFile(path, content_type=None, gzipped=True):
     """
     General function returning static files and ensuring the content type is
@@ -70,8 +86,10 @@ async def static(request, stat_file):
     """
     Static files handler
     """
-    # pylint: disable=unused-argument
     logging.debug("Web request: static file: %s", stat_file)
+    # The browser still has the current version of this file?
+    if GZIPPED_STATIC and request.headers.get('If-None-Match') == STATIC_ETAG:
+        return '', 304, {'ETag': STATIC_ETAG}
     # Images are never gzipped
     if stat_file.endswith('.png') or stat_file.endswith('.jpg'):
         gzipped = False
@@ -79,11 +97,22 @@ async def static(request, stat_file):
         gzipped = GZIPPED_STATIC
 
     gc.collect()
-    return staticFile(f'static/{stat_file}', gzipped=gzipped)
+    stat_f = staticFile(f'static/{stat_file}', gzipped=gzipped)
+    if GZIPPED_STATIC:
+        stat_f.headers['Cache-Control'] = 'no-cache'
+        stat_f.headers['ETag'] = STATIC_ETAG
+    return stat_f
 
-async def runserver(host='0.0.0.0', port=80, debug=True):
+async def runserver(host='0.0.0.0', port=80, debug=False):
     """
     Start the webserver.
+
+    Args:
+        host (str): The address to listen on
+        port (int): The port to listen on
+        debug (bool): If True, Microdot will print details for every request
+            served. This is useful for development, but adds overhead to every
+            request, so it is off by default.
     """
     logging.info("Starting web server on %s:%s", host, port)
     await app.start_server(host=host, port=port, debug=debug)
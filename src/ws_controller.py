@@ -2,6 +2,7 @@
 Controllers that communicate via the web socket established from the browser.
 """
 import uasyncio
+from utime import ticks_ms, ticks_add, ticks_diff
 from webserver import gc, app, logging
 from microdot_asyncio_websocket import with_websocket
 from version import VERSION
@@ -9,81 +10,137 @@ import ulogging as logging
 import ujson
 
 PING_DELAY = 10 # seconds
+# Pre-encoded frames for the constant messages we send. Microdot sends bytes
+# as is in a binary frame, instead of encoding a string for every send.
+PING_FRAME = b'active:ping'
+MOTION_RUN_FRAME = b'motion:run'
+MOTION_PAUSE_FRAME = b'motion:pause'
+OBST_ON_FRAME = b'obst:on'
+OBST_OFF_FRAME = b'obst:off'
+# The version does not change while running, so we encode its frame once
+VERSION_FRAME = ("version:%s" % VERSION).encode()
+# Template for the full hexapod state sent to the client on connection, as a
+# single newline separated frame.
+STATE_TMPL = "trim:%s\nmotion:%s\ndir:%s\nangle:%s\nspeed:%s\nstroke:%s\nobst:%s\nmemory:%s:%s"
 MEM_UPDATE_FREQ = 10 # seconds
 # This is an indicator to do or to not to do, obstacle detection. Obstacle
 # detection and reporting could at times be bad for response, so it can be
 # toggle on of off via the websocket interface.
 OBST_DETECT = False
-
-async def ping(wsock):
+# Obstacle frames are sent as pre-encoded bytes to avoid formatting and
+# encoding them on every send. The clear frame is constant, and the distance
+# frames are cached per integer distance, up to OBST_FRAMES_MAX entries after
+# which the cache is cleared.
+OBST_CLEAR_FRAME = b'obst:clear'
+OBST_FRAMES = {}
+OBST_FRAMES_MAX = 256
+
+def obstFrame(dist):
     """
-    Task to send regular pings to the remote end of the web socket.
+    Returns the pre-encoded obstacle frame for a given distance.
 
     Args:
-        wsock (socket): The web socket once the connection was been made.
-    """
-
-    while True:
-        await uasyncio.sleep(PING_DELAY)
-        logging.info("Sending ping...")
-        await wsock.send('active:ping')
+        dist (int): The obstacle distance in mm.
 
-async def memory(wsock):
+    Returns:
+        The frame as bytes: b'obst:dist'
+    """
+    frame = OBST_FRAMES.get(dist)
+    if frame is None:
+        if len(OBST_FRAMES) >= OBST_FRAMES_MAX:
+            OBST_FRAMES.clear()
+        frame = OBST_FRAMES[dist] = ("obst:%d" % dist).encode()
+    return frame
+
+async def wsTimers(wsock, ping_ms=PING_DELAY * 1000, mem_ms=MEM_UPDATE_FREQ * 1000):
     """
-    Task to send regular memory status updates to the UI.
+    Task to send regular pings and memory status updates to the remote end of
+    the web socket.
+
+    Instead of running a separate task for each of these periodic updates,
+    this task keeps the next due time for each, sleeps until the earliest one
+    is due, and then sends whichever is due.
 
     Args:
         wsock (socket): The web socket once the connection was been made.
+        ping_ms (int): Interval between pings in milliseconds
+        mem_ms (int): Interval between memory updates in milliseconds
     """
+    # The next due times are absolute and advanced by the interval, so the
+    # time spent sending does not make the intervals drift.
+    now = ticks_ms()
+    next_ping = ticks_add(now, ping_ms)
+    next_mem = ticks_add(now, mem_ms)
+
     while True:
-        await uasyncio.sleep(MEM_UPDATE_FREQ)
-        mem = f"{gc.mem_alloc()}:{gc.mem_free()}"
-        logging.info("Sending mem update: %s ...", mem)
-        await wsock.send(f"memory:{mem}")
+        delay = min(ticks_diff(next_ping, now), ticks_diff(next_mem, now))
+        if delay > 0:
+            await uasyncio.sleep_ms(delay)
+        now = ticks_ms()
 
-async def obstacleReporter(hexapod, wsock, interval=1000):
+        if ticks_diff(next_ping, now) <= 0:
+            await wsock.send(PING_FRAME)
+            next_ping = ticks_add(next_ping, ping_ms)
+
+        if ticks_diff(next_mem, now) <= 0:
+            mem = f"{gc.mem_alloc()}:{gc.mem_free()}"
+            logging.info("Sending mem update: %s ...", mem)
+            await wsock.send(f"memory:{mem}")
+            next_mem = ticks_add(next_mem, mem_ms)
+
+        now = ticks_ms()
+
+async def obstacleReporter(hexapod, wsock):
     """
-    Task to query the hexapod for any obstacles and if any, report it on the
+    Task to wait for obstacle changes on the hexapod and report these on the
     websocket - only if OBST_DETECT is True.
 
-    If the hexapod does not have a distance sensor configured (obstacle
-    property returns -1), this task will exit.
+    The task registers its own obstacle listener on the hexapod, and removes
+    it again when it exits or is cancelled.
+
+    If the hexapod does not have a distance sensor configured
+    (addObstacleListener returns None), this task will exit.
 
     Args:
         hexapod (inst): Hexapod instance.
         wsock (socket): The open websocket instance
-        interval (int): Interval between obstacle checks in milliseconds
     """
-    dist = hexapod.obstacle
+    event = hexapod.addObstacleListener()
     # Not configured?
-    if dist == -1:
+    if event is None:
         logging.error("Obstacle monitor not setup up. Exiting monitor.")
         return
 
-    has_cleared = True
-    while True:
-        # If detection is off, we only sleep and then rinse and repeat
-        if not OBST_DETECT:
-            await uasyncio.sleep_ms(interval)
-            continue
-
-        dist = hexapod.obstacle
-        # Obstacle?
-        if dist is not None:
-            # Send obstacle info
-            await wsock.send(f'obst:{dist}')
-            # Indicate that we have send a cleared message once the obstacle is
-            # cleared later.
-            has_cleared = False
-        elif not has_cleared:
-            # No obstacle detected, but we have also not let the client know
-            # that it is now cleared. Do it now
-            await wsock.send('obst:clear')
-            # We only want to send the cleared message once, so set the cleared
-            # flag
-            has_cleared = True
-
-        await uasyncio.sleep_ms(interval)
+    # The last frame we have sent. The client starts off with no obstacle, so
+    # this is the same as having sent a clear frame.
+    last = OBST_CLEAR_FRAME
+    # Force an initial report so that a new client learns about an obstacle
+    # that is already present if detection is on.
+    event.set()
+    try:
+        while True:
+            # Wait for the obstacle distance to change
+            await event.wait()
+            event.clear()
+
+            # If detection is off, we ignore the change and wait for the next
+            # one. The client clears its obstacle display when detection is
+            # switched off, so we reset the last frame sent to match. The
+            # listeners are notified on every detection toggle, so we always
+            # get here when it is switched off.
+            if not OBST_DETECT:
+                last = OBST_CLEAR_FRAME
+                continue
+
+            dist = hexapod.obstacle
+            frame = OBST_CLEAR_FRAME if dist is None else obstFrame(dist)
+            # Only send the frame if it differs from the last one sent. Frames
+            # are cached, so an identity check is enough.
+            if frame is not last:
+                await wsock.send(frame)
+                last = frame
+    finally:
+        hexapod.removeObstacleListener(event)
 
 def handleTrim(val, hexapod):
     """
@@ -112,44 +169,44 @@ def handleTrim(val, hexapod):
         On error, returns a string:
             "err:The error message"
     """
-    # Preset the response so we can test if was already set to an error later
-    resp = None
-
     # Need to set trims?
     if val is not None:
         logging.info("Setting trims: %s", val)
-        # Split on colons and check for the correct number of items
+        # Split on colons and pop the center element off if present, else
+        # default to false
         vals = val.split(':')
-        if len(vals) not in [3, 4]:
-            return f"err:Invalid trim values: {val}"
-
-        # Pop the center element off if present, else default to false
         cent = vals.pop() if len(vals) == 4 else 'false'
         if cent not in ['true', 'false']:
             return f"err:Invalid trim center value: {cent}"
         # Make the center value a boolean
         cent = cent == 'true'
 
+        # A single unpack validates that we have exactly three trim values
+        # left, without having to check the length up front.
+        try:
+            left, mid, right = vals
+        except ValueError:
+            return f"err:Invalid trim values: {val}"
+
         # Try convert the trims to ints
         try:
-            vals = [int(v) for v in vals]
+            vals = [int(left), int(mid), int(right)]
         except ValueError:
             return f"err:One or more trim values are not integers: {vals}"
         # Set the trims
-        hexapod.trim = vals
+        try:
+            hexapod.trim = vals
+        except ValueError as exc:
+            return f"err:{exc}"
         # Do we also center?
         if cent:
             hexapod.centerServos(True)
-    else:
-        logging.info("Requesting current trim settings.")
-
-    # Now set a response if we have not done so already
-    if resp is None:
-        # Need to convert the integers to strings before joining with a
-        # string
-        resp = ":".join([str(t) for t in hexapod.trim])
+        # We already know the trim values we have just set, so there is no
+        # need to read them back from the hexapod for the response.
+        return "%d:%d:%d" % (vals[0], vals[1], vals[2])
 
-    return resp
+    logging.info("Requesting current trim settings.")
+    return "%d:%d:%d" % tuple(hexapod.trim)
 
 def handleMotion(val, hexapod):
     """
@@ -185,114 +242,79 @@ def handleDirection(val, hexapod):
         hexapod (inst): Instance of the hexapod
 
     Returns:
-        A dictionary to indicate the current direction and angle:
-        {
-            'dir': one of 'fwd', 'rev', 'rotr', 'rotl'
-            'angle': current angle for the direction
-        }
+        The full response for the current direction and angle, as a single
+        newline separated frame:
+            "dir:direction\nangle:angle"
+
+        On error, returns a string:
+            "dir:err:The error message"
     """
     # Validate input
     if val not in ('fwd', 'rev', 'rotr', 'rotl'):
         logging.info("Invalid direction request: %s", val)
-        return f"err:Invalid direction request: {val}"
+        return f"dir:err:Invalid direction request: {val}"
 
-    # Either pause or do not...
+    # Set the direction
     hexapod.steer = {'dir': val}
 
-    # We just return the current steer result
-    return hexapod.steer
+    # We know the direction we have just set, so we only need to get the
+    # angle, which would have been reset, from the hexapod.
+    return "dir:%s\nangle:%s" % (val, hexapod.angle)
 
-def handleAngle(val, hexapod):
+def handleIntAttr(val, hexapod, name, vmin, vmax):
     """
-    Handles a request to set the steer angle.
+    Handles a request to set an integer hexapod attribute like the steer
+    angle, speed or stroke percentage.
 
     Args:
-        val (str): An angle: -90 <= val <= 90
+        val (str): The integer value: vmin <= val <= vmax
         hexapod (inst): Instance of the hexapod
+        name (str): The hexapod attribute to set, e.g. 'angle', 'speed' or
+            'stroke'
+        vmin (int): The min value allowed. Only if this is negative will a
+            leading minus sign be accepted on val.
+        vmax (int): The max value allowed
 
     Returns:
-        The angle as set or and error
+        The value as set or and error
     """
-    # Validate input
+    # Validate input. We expect an optional minus sign followed by at most 3
+    # digits, which we check up front so we do not need to catch an exception
+    # for invalid input. The value is only converted once it is known to be
+    # valid, and then reused.
+    digits = val[1:] if vmin < 0 and val and val[0] == '-' else val
+    num = int(val) if digits and digits.isdigit() and len(digits) <= 3 else None
+    if num is None or not vmin <= num <= vmax:
+        logging.info("Invalid %s: %s", name, val)
+        return f"err:Invalid {name}: {val}"
+
+    # The hexapod may raise a ValueError if the value can not be set in the
+    # current state, for example an angle when not going 'fwd' or 'rev'
     try:
-        # Convert to base 10 integer
-        angle = int(val, 10)
-        if not -90 <= angle <= 90:
-            raise ValueError
-    except ValueError:
-        logging.info("Invalid angle: %s", val)
-        return f"err:Invalid angle: {val}"
-
-    # If the current direction is not valid for setting and angle, a ValueError
-    # will be raised
-    try:
-        hexapod.steer = {'angle': angle}
+        setattr(hexapod, name, num)
     except ValueError as exc:
-        logging.info("Error setting angle %s", exc)
+        logging.info("Error setting %s %s", name, exc)
         return f"err:{exc}"
 
-    # We just return the current angle
+    # We just return the current value
     return val
 
-def handleSpeed(val, hexapod):
-    """
-    Handles a request to set the speed.
-
-    Args:
-        val (str): A speed percentage: 0 <= val <= 100
-        hexapod (inst): Instance of the hexapod
-
-    Returns:
-        The speed percentage as set or and error
-    """
-    # Validate input
-    try:
-        # Convert to base 10 integer
-        speed = int(val, 10)
-        if not 0 <= speed <= 100:
-            raise ValueError
-    except ValueError:
-        logging.info("Invalid speed: %s", val)
-        return f"err:Invalid speed: {val}"
-
-    try:
-        hexapod.speed = speed
-    except ValueError as exc:
-        logging.info("Error setting speed %s", exc)
-        return f"err:{exc}"
-
-    # We just return the current speed
-    return val
-
-def handleStroke(val, hexapod):
-    """
-    Handles a request to set the stroke percentage.
-
-    Args:
-        val (str): A stroke percentage: 0 <= val <= 100
-        hexapod (inst): Instance of the hexapod
-
-    Returns:
-        The stroke percentage as set or and error
-    """
-    # Validate input
-    try:
-        # Convert to base 10 integer
-        stroke = int(val, 10)
-        if not 0 <= stroke <= 100:
-            raise ValueError
-    except ValueError:
-        logging.info("Invalid stroke: %s", val)
-        return f"err:Invalid stroke: {val}"
-
-    try:
-        hexapod.stroke = stroke
-    except ValueError as exc:
-        logging.info("Error setting stroke %s", exc)
-        return f"err:{exc}"
-
-    # We just return the current stroke
-    return val
+# Dispatch table for the actions that are handled by one of the handle*
+# functions above, and that respond with the action and the handler's return
+# value. Each action maps to a (handler, response template, extra handler
+# args) tuple.
+# NOTE: The templates are %-style format strings since these are formatted in
+#   one go, where f-strings in MicroPython build the result from intermediate
+#   strings. The same goes for the log messages in the websocket loop, where
+#   the %-style args also allows formatting to be skipped if the log level is
+#   not enabled.
+HANDLERS = {
+    'trim': (handleTrim, "trim:%s", ()),
+    'motion': (handleMotion, "motion:%s", ()),
+    'angle': (handleIntAttr, "angle:%s", ('angle', -90, 90)),
+    'speed': (handleIntAttr, "speed:%s", ('speed', 0, 100)),
+    'stroke': (handleIntAttr, "stroke:%s", ('stroke', 0, 100)),
+}
 
 @app.route('/ws')
 @with_websocket
@@ -317,96 +339,95 @@ async def websock(request, ws):
     hexapod = request.app.hexapod
 
     # Create the tasks
-    #uasyncio.create_task(ping(ws))
-    #uasyncio.create_task(memory(ws))
-    uasyncio.create_task(obstacleReporter(hexapod, ws))
-
-    # Send the initial hexapod state so the UI can update itself
-    await ws.send(f"trim:{handleTrim(None, hexapod)}")
-    await ws.send(f"motion:{'pause' if hexapod.pause else 'run'}")
-    await ws.send(f"dir:{hexapod.steer['dir']}")
-    await ws.send(f"angle:{hexapod.steer['angle']}")
-    await ws.send(f"speed:{hexapod.speed}")
-    await ws.send(f"stroke:{hexapod.stroke}")
-    await ws.send(f"obst:{'on' if OBST_DETECT else 'off'}")
-    await ws.send(f"memory:{gc.mem_alloc()}:{gc.mem_free()}")
+    #uasyncio.create_task(wsTimers(ws))
+    # No need for an obstacle reporter if there is no sensor to report for.
+    # We keep the task so that it can be cancelled when the connection
+    # closes, which also removes its obstacle listener.
+    reporter = None
+    if hexapod.hasObstacleSensor:
+        reporter = uasyncio.create_task(obstacleReporter(hexapod, ws))
 
-    while True:
-        # Wait for a message and then split it on the first colon into action
-        # and arguments
-        data = await ws.receive()
-        data = data.split(':', 1)
-        # All actions do not always have arguments, so work out what the action
-        # and args are. No args will result in args == None
-        if len(data) == 1:
-            action = data[0]
-            args = None
-        else:
-            action, args = data
-        logging.debug(f"[WS]: Received: action: {action}, args: {args}")
-
-        # What to do?
-        response = None
-        if action == 'version':
-            response = f"version:{VERSION}"
-        elif action == 'memory':
-            response = f"memory:{gc.mem_alloc()}:{gc.mem_free()}"
-        elif action == 'osc':
-            response = f"osc:{ujson.dumps(hexapod.oscState)}"
-        elif action == 'obst':
-            # We only accept 'on', 'off' or 'toggle' here
-            if not args in ('on', 'off', 'toggle'):
-                response = f"err:invalid obstacle switch command: {args}"
-            else:
-                if args == 'toggle':
-                    OBST_DETECT = not OBST_DETECT
-                elif args == 'on':
-                    OBST_DETECT = True
-                else:
-                    OBST_DETECT = False
-                response = (f"obst:{'on' if OBST_DETECT else 'off'}")
-        elif action == 'pong':
-            logging.info("Received pong...")
-        elif action == 'center':
-            logging.info("Received serve center request...")
-            # Center, taking trim into account
-            hexapod.centerServos(True)
-            # This could have affected the state of motion, so we return the
-            # current pause state
-            response = f"motion:{'pause' if hexapod.pause else 'run'}"
-        elif action == 'trim':
-            logging.info(f"Received trim:{args}...")
-            response = f"trim:{handleTrim(args, hexapod)}"
-        elif action == 'motion':
-            logging.info(f"Received motion:{args}...")
-            response = f"motion:{handleMotion(args, hexapod)}"
-        elif action == 'dir':
-            logging.info(f"Received dir:{args}...")
-            # We will be sending a response for the direction as well as for
-            # the steering angle
-            resp = handleDirection(args, hexapod)
-            # Set up the response tuple
-            response = (
-                f"dir:{resp['dir']}",
-                f"angle:{resp['angle']}",
+    try:
+        # Send the initial hexapod state so the UI can update itself. All state
+        # messages are sent in a single newline separated frame.
+        await ws.send(
+            STATE_TMPL % (
+                handleTrim(None, hexapod),
+                'pause' if hexapod.pause else 'run',
+                hexapod.steer['dir'],
+                hexapod.angle,
+                hexapod.speed,
+                hexapod.stroke,
+                'on' if OBST_DETECT else 'off',
+                gc.mem_alloc(),
+                gc.mem_free(),
             )
-        elif action == 'angle':
-            logging.info(f"Received angle:{args}...")
-            response = f"angle:{handleAngle(args, hexapod)}"
-        elif action == 'speed':
-            logging.info(f"Received speed:{args}...")
-            response = f"speed:{handleSpeed(args, hexapod)}"
-        elif action == 'stroke':
-            logging.info(f"Received stroke:{args}...")
-            response = f"stroke:{handleStroke(args, hexapod)}"
-        else:
-            logging.info(f"Unhandled action: {action}")
-
-        # Any response?
-        if response:
-            # To handle multiple responses, we force the response into a list
-            # if not one already
-            if not isinstance(response, (list, tuple)):
-                response = (response,)
-            for resp in response:
-                await ws.send(resp)
+        )
+
+        while True:
+            # Wait for a message and then partition it on the first colon into
+            # action and arguments
+            data = await ws.receive()
+            action, sep, args = data.partition(':')
+            # All actions do not always have arguments. No args will result in
+            # args == None
+            if not sep:
+                args = None
+            # This is the only log line for every received message. It is only
+            # formatted if debug logging is enabled, so we do not pay for it in
+            # normal operation.
+            logging.debug("[WS]: Received: action: %s, args: %s", action, args)
+
+            # What to do? The common actions are dispatched via the HANDLERS
+            # table, and the rest are special cased below.
+            response = None
+            handler = HANDLERS.get(action)
+            if handler is not None:
+                func, tmpl, extra = handler
+                response = tmpl % func(args, hexapod, *extra)
+            elif action == 'version':
+                response = VERSION_FRAME
+            elif action == 'memory':
+                response = "memory:%s:%s" % (gc.mem_alloc(), gc.mem_free())
+            elif action == 'osc':
+                response = "osc:%s" % ujson.dumps(hexapod.oscState)
+            elif action == 'obst':
+                # We only accept 'on', 'off' or 'toggle' here
+                if not args in ('on', 'off', 'toggle'):
+                    response = "err:invalid obstacle switch command: %s" % args
+                else:
+                    if args == 'toggle':
+                        OBST_DETECT = not OBST_DETECT
+                    elif args == 'on':
+                        OBST_DETECT = True
+                    else:
+                        OBST_DETECT = False
+                    # Notify the obstacle reporters on every toggle. When switching
+                    # off, this resets their last sent frame to match the cleared
+                    # client display, and when switching on, it forces them to
+                    # report the current state instead of waiting for a change.
+                    hexapod.notifyObstacleListeners()
+                    response = OBST_ON_FRAME if OBST_DETECT else OBST_OFF_FRAME
+            elif action == 'pong':
+                # Nothing to do for a pong
+                pass
+            elif action == 'center':
+                # Center, taking trim into account
+                hexapod.centerServos(True)
+                # This could have affected the state of motion, so we return the
+                # current pause state
+                response = MOTION_PAUSE_FRAME if hexapod.pause else MOTION_RUN_FRAME
+            elif action == 'dir':
+                # This response includes the direction as well as the steering
+                # angle, combined in a single newline separated frame
+                response = handleDirection(args, hexapod)
+            else:
+                logging.info("Unhandled action: %s", action)
+
+            # Any response?
+            if response:
+                await ws.send(response)
+    finally:
+        # The connection is closed, so the reporter has nothing to report to
+        if reporter is not None:
+            reporter.cancel()